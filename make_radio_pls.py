@@ -4,46 +4,34 @@
 from __future__ import unicode_literals, print_function
 
 import argparse
+import collections
+import functools
+import io
+import json
 import os
+import pathlib
 import signal
 import sys
+import tempfile
 
-# compat
-if sys.version_info.major < 3:
-    str = unicode
+# PyYAML is imported on first use, as it is only needed for yaml configs
+_yaml = None
 
 
-_playlist_format = """
-[playlist]
+def write_playlist(entries, out):
+    """ Write a PLS playlist of track entries to a text stream.
 
-{content}
-
-NumberOfEntries={entries:d}
-Version={version:d}
-""".strip()
-
-
-_entry_format = """
-Title{num:d}={title}
-File{num:d}={url}
-Length{num:d}={length:d}
-""".strip()
-
-
-def format_playlist(entries):
-    """ Format a PLS playlist from a list of formatted track entries. """
-    return _playlist_format.format(
-        content="\n\n".join(
-            "{:{index}}".format(entry, index=idx)
-            for idx, entry in enumerate(entries, 1)
-        ),
-        entries=len(entries),
-        version=2)
-
-
-def format_entry(title, url, length=-1, num=0):
-    """ Format a single playlist track. """
-    return _entry_format.format(title=title, url=url, length=length, num=num)
+    Each entry is written as it is rendered, so that the full playlist is
+    never held in memory as a single string.
+    """
+    out.write("[playlist]\n\n")
+    idx = 0
+    for idx, entry in enumerate(entries, 1):
+        out.write(entry.render(idx) + "\n\n")
+    if not idx:
+        # Keep the empty content section of the original playlist format
+        out.write("\n\n")
+    out.write(f"NumberOfEntries={idx}\nVersion=2\n")
 
 
 class PlsEntry(object):
@@ -57,11 +45,12 @@ class PlsEntry(object):
         :param str title: Title of the playlist entry.
         :param str fileurl: The path or url of the playlist entry.
         :param int length: The playtime length of the playlist item
+        :param tags: An iterable of tags for the playlist entry.
         """
-        self.title = str(title)
-        self.file = str(fileurl)
+        self.title = title if type(title) is str else str(title)
+        self.file = fileurl if type(fileurl) is str else str(fileurl)
         self.length = int(length)
-        self.tags = set(tags or ())
+        self.tags = frozenset(sys.intern(str(t)) for t in (tags or ()))
 
     def __cmp__(self, other):
         """ Compare playlist entries by title. """
@@ -71,22 +60,21 @@ class PlsEntry(object):
 
     def __str__(self):
         """ String value of this playlist entry. """
-        return str(self.title)
+        return self.title
 
     def __repr__(self):
         """ Literal representation of this entry. """
-        u = '{cls}({t}, {f}, length={l}, tags={tt})'.format(
-            cls=type(self).__name__,
-            t=repr(self.title),
-            f=repr(self.file),
-            l=repr(self.length),
-            tt=repr(tuple(self.tags)),
-        )
-        return str(u)
+        return (f"{type(self).__name__}({self.title!r}, {self.file!r}, "
+                f"length={self.length!r}, tags={tuple(self.tags)!r})")
 
     def __format__(self, entry_number):
-        num = int(entry_number)
-        return format_entry(self.title, self.file, length=self.length, num=num)
+        return self.render(int(entry_number))
+
+    def render(self, num):
+        """ Format this entry as playlist track number `num`. """
+        return (f"Title{num}={self.title}\n"
+                f"File{num}={self.file}\n"
+                f"Length{num}={self.length}")
 
     def has_tag(self, tag):
         return tag in self.tags
@@ -100,7 +88,8 @@ class PlaylistCollection(object):
     """ A collection of PlsEntries. """
 
     def __init__(self, *args):
-        self.__entries = []
+        # Insertion ordered, used as an ordered set
+        self.__entries = {}
 
         for item in args:
             if not isinstance(item, PlsEntry):
@@ -109,20 +98,17 @@ class PlaylistCollection(object):
 
     @property
     def entries(self):
-        return self.__entries
+        return self.__entries.keys()
 
     def add(self, item):
         if not isinstance(item, PlsEntry):
             raise ValueError("Invalid item {!r}".format(item))
-        elif item in self.entries:
-            return
-        self.__entries.append(item)
+        self.__entries[item] = None
 
     def get(self, *tags):
+        tagset = frozenset(tags)
         for item in self.entries:
-            if not tags:
-                yield item
-            elif any(item.has_tag(tag) for tag in tags):
+            if not tags or not item.tags.isdisjoint(tagset):
                 yield item
 
     @classmethod
@@ -131,29 +117,102 @@ class PlaylistCollection(object):
         return cls(*entries)
 
 
-def parse_config(filename):
-
-    def parse_json_config(filename):
-        import json
-        data = {}
-        with open(filename, 'r') as f:
-            data = json.load(f)
+def _load_cached(filename, load):
+    """ Load data from a file, caching the parsed result as json.
+
+    The cache is kept next to the file, and records the mtime and size of the
+    file it was built from. It is only used if both still match the file.
+    """
+    cache = filename + '.cache.json'
+    st = os.stat(filename)
+    try:
+        cached = json.loads(pathlib.Path(cache).read_bytes())
+        if (cached['mtime_ns'] == st.st_mtime_ns and
+                cached['size'] == st.st_size):
+            return cached['data']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    data = load(filename)
+    try:
+        serialized = json.dumps({
+            'mtime_ns': st.st_mtime_ns,
+            'size': st.st_size,
+            'data': data,
+        })
+    except (TypeError, ValueError):
+        # Data is not json-serializable
         return data
 
-    def parse_yaml_config(filename):
-        import yaml
-        data = {}
-        with open(filename, 'r') as f:
-            data = yaml.safe_load(f)
+    try:
+        f = tempfile.NamedTemporaryFile(
+            'w',
+            dir=os.path.dirname(cache) or os.curdir,
+            prefix=os.path.basename(cache) + '.',
+            suffix='.tmp',
+            delete=False)
+    except OSError:
+        # Cache is not writable
         return data
+    try:
+        with f:
+            f.write(serialized)
+        # NamedTemporaryFile is created with mode 0600, follow the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(f.name, 0o666 & ~umask)
+        os.replace(f.name, cache)
+    except OSError:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+    return data
+
+
+def _parse_json(filename):
+    return json.loads(pathlib.Path(filename).read_bytes())
+
+
+def _load_yaml(filename):
+    global _yaml
+    if _yaml is None:
+        import yaml as _yaml
+    loader = getattr(_yaml, 'CSafeLoader', _yaml.SafeLoader)
+    return _yaml.load(pathlib.Path(filename).read_bytes(), Loader=loader)
 
+
+def _parse_yaml(filename):
+    return _load_cached(filename, _load_yaml)
+
+
+_config_parsers = {
+    '.yml': _parse_yaml,
+    '.yaml': _parse_yaml,
+    '.json': _parse_json,
+    '.js': _parse_json,
+}
+
+
+def parse_config(filename):
+    """ Parse a json or yaml config file.
+
+    Results are memoized for as long as the file remains unchanged. The
+    returned data should be treated as read-only.
+    """
     f_ext = os.path.splitext(filename)[1]
-    if f_ext in ('.yml', '.yaml'):
-        return parse_yaml_config(filename)
-    elif f_ext in ('.json', '.js'):
-        return parse_json_config(filename)
-    raise argparse.ArgumentTypeError(
-        "Unknown file type '{!s}' ({!s})".format(f_ext, filename))
+    try:
+        parse = _config_parsers[f_ext]
+    except KeyError:
+        raise argparse.ArgumentTypeError(
+            "Unknown file type '{!s}' ({!s})".format(f_ext, filename)
+        ) from None
+    return _parse_config_cached(parse, filename, os.path.getmtime(filename))
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_config_cached(parse, filename, mtime):
+    return parse(filename)
 
 
 default_encoding = 'utf-8'
@@ -202,38 +261,23 @@ def main(args=None):
     entries = pls_data.get(*(args.tags or ()))
 
     if args.list:
-        for entry in entries:
-            print("{!s} ({!s})".format(entry, ','.join(entry.tags)))
+        sys.stdout.write("".join([
+            "{!s} ({!s})\n".format(entry, ','.join(entry.tags))
+            for entry in entries]))
         raise SystemExit(0)
 
     if args.list_tags:
-        tags = dict()
+        tags = collections.defaultdict(list)
         for entry in entries:
             for tag in entry.tags:
-                tags.setdefault(tag, []).append(entry)
-        for tag in sorted(tags):
-            print(
-                "{!s}:\n  {!s}".format(
-                    tag, "\n  ".join(str(e) for e in tags[tag])))
+                tags[tag].append(entry)
+        sys.stdout.write("".join([
+            "{!s}:\n  {!s}\n".format(
+                tag, "\n  ".join(str(e) for e in tagged))
+            for tag, tagged in sorted(tags.items())]))
         raise SystemExit(0)
 
-    print(format_playlist(list(entries)))
-
-
-def get_safe_print(encoding):
-
-    _real_print = print
-
-    def encode_print(*args, **kwargs):
-        kwargs.setdefault('file', sys.stdout)
-        if kwargs['file'] == sys.stdout:
-            args = tuple(
-                value.encode(encoding)
-                if isinstance(value, str)
-                else value
-                for value in args)
-        _real_print(*args, **kwargs)
-        return encode_print
+    write_playlist(entries, sys.stdout)
 
 
 if __name__ == '__main__':
@@ -243,7 +287,13 @@ if __name__ == '__main__':
     if (not os.isatty(sys.stdout.fileno()) and
             'PYTHONIOENCODING' not in os.environ):
         # Stdout is redirected, and we're missing a sensible default encoding.
-        # Try to encode all unicode objects as DEFAULT_ENCODING when printing
-        # to stdout.
-        print = get_safe_print(default_encoding)
+        # Use DEFAULT_ENCODING when writing to stdout.
+        try:
+            sys.stdout.reconfigure(encoding=default_encoding,
+                                   errors='replace')
+        except AttributeError:
+            sys.stdout = io.TextIOWrapper(sys.stdout.buffer,
+                                          encoding=default_encoding,
+                                          errors='replace',
+                                          write_through=True)
     main()